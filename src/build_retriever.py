@@ -22,12 +22,27 @@ logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
 MODEL_PATH = '../model/nvidia/NV-Embed-v1'
+# autocast dtype for encoding, None keeps fp32. This only changes the matmul
+# precision, the weights are still loaded in fp32 (~28 GB); pass torch_dtype
+# to from_pretrained to save memory. Rebuild the faiss index after changing it.
+AMP_DTYPE = None
+
+
+def encode(model, sentences, batch_size, max_length, amp_dtype=None):
+    # _do_encode is already no_grad, inference_mode only drops version counting
+    with torch.inference_mode(), torch.autocast('cuda', dtype=amp_dtype or torch.bfloat16, enabled=amp_dtype is not None):
+        emb = model._do_encode(sentences, batch_size=batch_size, instruction="", max_length=max_length)
+    if torch.is_tensor(emb):
+        # faiss and np.concatenate need float32 numpy
+        emb = emb.float().cpu().numpy()
+    return emb
 
 class VectorstoreBuilder:
-    def __init__(self, db_type:str, mnt_root:str):
+    def __init__(self, db_type:str, mnt_root:str, amp_dtype=AMP_DTYPE):
         self.type = db_type 
         self.work_root = osp.dirname(osp.dirname(osp.abspath(__file__)))
         self.mnt_root = mnt_root
+        self.amp_dtype = amp_dtype
     
     def load_documents(self):
         doc_path = osp.join(self.work_root, 'processed_data', 'documents.pt')
@@ -40,12 +55,11 @@ class VectorstoreBuilder:
             # raw_doc = raw_doc1
 
             doc_list = []
-            for doc_id in raw_doc.keys():
-                if raw_doc[doc_id]['title'] is None:
+            for doc_id, paper in raw_doc.items():
+                title = paper['title']
+                if title is None:
                     title = ' '
-                else:
-                    title = raw_doc[doc_id]['title']
-                doc = Document(page_content= '# ' + title + '\n\n' + raw_doc[doc_id]['abstract'],
+                doc = Document(page_content= '# ' + title + '\n\n' + paper['abstract'],
                                           metadata={'pid':doc_id})
                 doc_list.append(doc)
             torch.save(doc_list, doc_path)
@@ -69,12 +83,7 @@ class VectorstoreBuilder:
         return vectorstore
 
     def build_vectorstore_mutilGPU(self, embedding_model_path):
-        doc_list = self.load_documents()
-        
-        sentences, metadatas = [], []
-        for doc in doc_list:
-            sentences.append(doc.page_content)
-            metadatas.append(doc.metadata)
+        sentences, metadatas = self.load_data()
 
         sentences = sentences[:2048]
         metadatas = metadatas[:2048]
@@ -104,7 +113,7 @@ class VectorstoreBuilder:
         embs = []
         for i, chunk in enumerate(chunks):
             start = time.time()
-            emb = model._do_encode(chunk, batch_size=batch_size, instruction="", max_length=max_length)
+            emb = encode(model, chunk, batch_size, max_length, self.amp_dtype)
             print(f"gpu:{gpu_id} for chunk {i} time: {time.time() - start}")
             embs.append(emb)
             torch.cuda.empty_cache()
@@ -119,28 +128,26 @@ class VectorstoreBuilder:
 
         logging.info(f"gpu: {gpu_id}")
         start = time.time()
-        emb = model._do_encode(sentences, batch_size=batch_size, instruction="", max_length=max_length)
+        emb = encode(model, sentences, batch_size, max_length, self.amp_dtype)
         logging.info(f"gpu:{gpu_id} encode time: {time.time() -start}")
         return emb
 
     def load_data(self):
         doc_list = self.load_documents()
         
-        sentences, metadatas = [], []
-        for doc in doc_list:
-            sentences.append(doc.page_content)
-            metadatas.append(doc.metadata)
+        sentences = [doc.page_content for doc in doc_list]
+        metadatas = [doc.metadata for doc in doc_list]
 
         return sentences, metadatas
 
 
-def emb_batch_encode(sentences, gpu_id):
+def emb_batch_encode(sentences, gpu_id, amp_dtype=AMP_DTYPE):
     model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True).to(f"cuda:{gpu_id}")
     max_length = 2048
     batch_size = 32
 
     start = time.time()
-    emb = model._do_encode(sentences, batch_size=batch_size, instruction="", max_length=max_length)
+    emb = encode(model, sentences, batch_size, max_length, amp_dtype)
     print(f"gpu:{gpu_id} encode time: {time.time() -start}")
     return emb
 
@@ -149,6 +156,7 @@ if __name__ == '__main__':
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', type=int, default=0)
+    parser.add_argument('--bf16', action='store_true')
     args = parser.parse_args()
     model_name =  "nvidia/NV-Embed-v1"
     builder = VectorstoreBuilder(model_name, "../output")
@@ -163,6 +171,6 @@ if __name__ == '__main__':
     data_chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
 
     data_gpu = data_chunks[args.gpu]
-    emb = emb_batch_encode(data_gpu, args.gpu)
+    emb = emb_batch_encode(data_gpu, args.gpu, torch.bfloat16 if args.bf16 else None)
     mnt_root = '../output/'
     torch.save([sentences, emb, metadatas], osp.join(mnt_root, f'{model_name}_gpu_{args.gpu}_emb.bin'))
@@ -9,14 +9,18 @@ from typing import List
 from sentence_transformers import SentenceTransformer
 from  transformers import AutoTokenizer, AutoModel
 MODEL_PATH = '../model/nvidia/NV-Embed-v1'
+# autocast dtype for query encoding, None keeps fp32. Queries should be encoded
+# the same way as the corpus behind the cached faiss index.
+AMP_DTYPE = None
 
 class Retriever:
     
-    def __init__(self, db_path:str, embedding_model_path:str, faiss_index_path:str):
+    def __init__(self, db_path:str, embedding_model_path:str, faiss_index_path:str, amp_dtype=AMP_DTYPE):
         if torch.cuda.is_available():
             self.device = 'cuda'
         else:
             self.device = 'cpu'
+        self.amp_dtype = amp_dtype
         # hacking different length
         sentences, emb, metadatas = torch.load(db_path)
         self.sentences = sentences[:-3]
@@ -47,26 +51,25 @@ class Retriever:
 
         # self.query_embedder = SentenceTransformer(embedding_model_path, device=self.device, trust_remote_code=True)
         # self.sentences = np.array(self.sentences) # TODO: OOM bug
-        self.metadatas = np.array(self.metadatas)
+        # resolve pids once so lookups are a single fancy index per batch
+        self.pids = np.array([m["pid"] for m in self.metadatas])
         print('baseRetriever init successfully')
 
     def get_related_doc(self, query:List[str], top_k:int):
         max_length = 2048
         batch_size = 32
 
-        query_emb = self.query_embedder._do_encode(query, batch_size=batch_size, instruction="", max_length=max_length)
+        with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype or torch.bfloat16, enabled=self.amp_dtype is not None):
+            query_emb = self.query_embedder._do_encode(query, batch_size=batch_size, instruction="", max_length=max_length)
+        if torch.is_tensor(query_emb):
+            # faiss only accepts float32 numpy
+            query_emb = query_emb.float().cpu().numpy()
         # query = self.query_embedder.encode(query, normalize_embeddings=True, device=self.device)
         score, ids = self.vectorstore.search(query_emb, k=top_k)
         return ids
 
     def get_pid(self, all_ids):
-        doc_id_list = []
-        for ids in all_ids:
-            metadata_batch=self.metadatas[ids]
-            id_list = [m["pid"] for m in metadata_batch]
-            doc_id_list.append(id_list)
-
-        return doc_id_list
+        return self.pids[all_ids].tolist()
 
     def __call__(self, query:List[str], top_k:int=20):
         # TODO: batch infer query
@@ -98,6 +101,4 @@ if __name__ == '__main__':
     
     all_doc_id_list = retriever(all_retriever_input)
     with open(osp.join(work_root, 'result', f"nvidia_{ckpt_id}.txt"), 'w') as result_file:
-        for id_list in all_doc_id_list:
-            result_file.write(','.join(id_list))
-            result_file.write('\n')
+        result_file.writelines(','.join(id_list) + '\n' for id_list in all_doc_id_list)